@@ -1,17 +1,41 @@
+import errno
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from shutil import copyfile
 from typing import List, Dict
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 filename = "chapter2.txt"
 
 
-def load_data_from_file(path=None) -> str:
-    with open(path if path else filename, 'r') as f:
+def load_data_from_file(path=None) -> bytes:
+    with open(path if path else filename, 'rb') as f:
         data = f.read()
     return data
 
 
+@lru_cache(maxsize=4096)
+def _parse_name(name: str):
+    """Parse a mapping key ('1', '1-2') or shard filename ('1.txt',
+    '1-2.txt') into (shard id, replication level), with the level None for
+    primaries. The same small set of names gets parsed over and over on
+    every verify/rebalance pass, so results are memoized."""
+    root, _, _ = name.partition('.')
+    shard, sep, level = root.partition('-')
+    return int(shard), int(level) if sep else None
+
+
 class ShardHandler(object):
     """
     Take any text file and shard it into X number of files with
@@ -19,37 +43,128 @@ class ShardHandler(object):
     """
 
     def __init__(self):
-        self.mapping = self.load_map()
+        self.primaries, self.replicas = self._from_disk_format(self.load_map())
         self.last_char_position = 0
+        self._ids_cache = None
+        self.replication_level = self._scan_replication_level()
+        os.makedirs(self.data_dir, exist_ok=True)
+        # Opened eagerly: _fast_copy runs on thread-pool workers, and a
+        # lazy unsynchronized open could race and leak a descriptor.
+        self._dirfd = os.open(self.data_dir, os.O_RDONLY | os.O_DIRECTORY)
 
     mapfile = "mapping.json"
+    data_dir = "data"
+
+    def _data_dir_fd(self) -> int:
+        """Descriptor for the data directory, opened once in __init__ and
+        reused for every per-file operation. With a registered dirfd the
+        kernel only resolves the bare file name on each open/unlink/scan
+        instead of re-walking the directory prefix every time."""
+        return self._dirfd
+
+    @property
+    def mapping(self) -> Dict:
+        """The mapping in its on-disk, string-keyed form. Kept for external
+        callers; internal code works directly on the int-keyed `primaries`
+        and `replicas` dicts and only serializes on write_map."""
+        return self._to_disk_format()
+
+    def _to_disk_format(self) -> Dict:
+        """Flatten primaries and replicas into the string-keyed dict that
+        mapping.json stores ('1', '1-2', ...)."""
+        disk = {
+            str(db): dict(info) for db, info in sorted(self.primaries.items())
+        }
+        for db, levels in sorted(self.replicas.items()):
+            for level, info in sorted(levels.items()):
+                disk[f"{db}-{level}"] = dict(info)
+        return disk
+
+    @staticmethod
+    def _from_disk_format(disk: Dict):
+        """Expand the on-disk dict into int-keyed primaries ({id: info})
+        and replicas ({id: {level: info}}), so the hot paths never re-parse
+        string keys or compare ids as strings."""
+        primaries = {}
+        replicas = {}
+        for key, info in disk.items():
+            db, level = _parse_name(key)
+            if level is None:
+                primaries[db] = dict(info)
+            else:
+                replicas.setdefault(db, {})[level] = dict(info)
+        return primaries, replicas
 
     def write_map(self) -> None:
-        """Write the current 'database' mapping to file."""
-        with open(self.mapfile, 'w') as m:
-            json.dump(self.mapping, m, indent=2)
+        """Write the current 'database' mapping to file. Serialized with
+        orjson when it is installed (its C encoder is much faster as the
+        mapping grows), falling back to the stdlib otherwise. The mapping
+        is written to a temporary file, synced, and atomically renamed into
+        place so a crash mid-write can never leave a truncated mapfile."""
+        disk = self._to_disk_format()
+        if orjson is not None:
+            payload = orjson.dumps(disk, option=orjson.OPT_INDENT_2)
+        else:
+            payload = json.dumps(disk, indent=2).encode('utf-8')
+
+        tmpfile = self.mapfile + '.tmp'
+        fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, payload)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmpfile, self.mapfile)
 
     def load_map(self) -> Dict:
         """Load the 'database' mapping from file."""
         if not os.path.exists(self.mapfile):
             return dict()
-        with open(self.mapfile, 'r') as m:
+        with open(self.mapfile, 'rb') as m:
+            if orjson is not None:
+                return orjson.loads(m.read())
             return json.load(m)
 
+    def reload_map(self) -> None:
+        """Re-read the mapping from disk. The handler keeps the mapping in
+        memory and is the only writer, so mutating methods never need this;
+        it exists for callers who expect an external process to have touched
+        the mapfile."""
+        self.primaries, self.replicas = self._from_disk_format(self.load_map())
+        self.replication_level = self._scan_replication_level()
+        self._invalidate_ids_cache()
+
     def _reset_char_position(self):
         self.last_char_position = 0
 
-    def get_shard_ids(self):
-        return sorted([key for key in self.mapping.keys() if '-' not in key])
+    def _get_ids(self):
+        """Sort the shard ids and (id, level) replication pairs once, then
+        reuse the result until the mapping mutates; the hot paths call the
+        id getters far more often than the mapping changes."""
+        if self._ids_cache is None:
+            primaries = sorted(self.primaries)
+            replications = sorted(
+                (db, level)
+                for db, levels in self.replicas.items()
+                for level in levels
+            )
+            self._ids_cache = (primaries, replications)
+        return self._ids_cache
+
+    def _invalidate_ids_cache(self):
+        self._ids_cache = None
 
-    def get_replication_ids(self):
-        return sorted([key for key in self.mapping.keys() if '-' in key])
+    def get_shard_ids(self) -> List[int]:
+        return self._get_ids()[0]
 
-    def build_shards(self, count: int, data: str = None) -> [str, None]:
+    def get_replication_ids(self) -> List[tuple]:
+        return self._get_ids()[1]
+
+    def build_shards(self, count: int, data: bytes = None) -> [str, None]:
         """Initialize our miniature databases from a clean mapfile. Cannot
         be called if there is an existing mapping -- must use add_shard() or
         remove_shard()."""
-        if self.mapping != {}:
+        if self.primaries:
             return "Cannot build shard setup -- sharding already exists."
 
         spliced_data = self._generate_sharded_data(count, data)
@@ -59,96 +174,185 @@ class ShardHandler(object):
 
         self.write_map()
 
-    def _write_shard_mapping(self, num: str, data: str, replication=False):
+    def _write_shard_mapping(self, num: str, data: memoryview, replication=False):
         """Write the requested data to the mapfile. The optional `replication`
         flag allows overriding the start and end information with the shard
         being replicated."""
+        db, level = _parse_name(num)
         if replication:
-            parent_shard = self.mapping.get(num[:num.index('-')])
-            self.mapping.update(
-                {
-                    num: {
-                        'start': parent_shard['start'],
-                        'end': parent_shard['end']
-                    }
-                }
-            )
+            parent_shard = self.primaries[db]
+            self.replicas.setdefault(db, {})[level] = {
+                'start': parent_shard['start'],
+                'end': parent_shard['end']
+            }
         else:
-            if int(num) == 0:
+            if db == 0:
                 # We reset it here in case we perform multiple write operations
                 # within the same instantiation of the class. The char position
                 # is used to power the index creation.
                 self._reset_char_position()
 
-            self.mapping.update(
-                {
-                    str(num): {
-                        'start': (
-                            self.last_char_position if
-                            self.last_char_position == 0 else
-                            self.last_char_position + 1
-                        ),
-                        'end': self.last_char_position + len(data)
-                    }
-                }
-            )
+            self.primaries[db] = {
+                'start': (
+                    self.last_char_position if
+                    self.last_char_position == 0 else
+                    self.last_char_position + 1
+                ),
+                'end': self.last_char_position + len(data)
+            }
 
             self.last_char_position += len(data)
 
-    def _write_shard(self, num: int, data: str) -> None:
+        self._invalidate_ids_cache()
+
+    def _write_shard(self, num: int, data: memoryview) -> None:
         """Write an individual database shard to disk and add it to the
-        mapping."""
-        if not os.path.exists("data"):
-            os.mkdir("data")
-        with open(f"data/{num}.txt", 'w') as s:
-            s.write(data)
+        mapping. The bytes go out with writev straight from the view into
+        the shared data buffer, skipping the buffered-file copy."""
+        fd = os.open(
+            f"{num}.txt", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644,
+            dir_fd=self._data_dir_fd()
+        )
+        try:
+            os.writev(fd, [data])
+        finally:
+            os.close(fd)
         self._write_shard_mapping(str(num), data)
 
-    def _generate_sharded_data(self, count: int, data: str) -> List[str]:
-        """Split the data into as many pieces as needed."""
-        splicenum, rem = divmod(len(data), count)
-
-        result = [data[splicenum * z:splicenum * (z + 1)] for z in range(count)]
-        # take care of any odd characters
+    def _generate_sharded_data(self, count: int, data: bytes) -> List[memoryview]:
+        """Split the data into as many pieces as needed. The pieces are
+        zero-copy views over the original buffer, so start/end positions in
+        the mapping count bytes rather than characters."""
+        mv = memoryview(data)
+        splicenum, rem = divmod(len(mv), count)
+
+        if numpy is not None and rem == 0 and count <= 1024:
+            # Equal split: one reshape gives every row as a view over the
+            # original buffer with no per-slice Python-level arithmetic.
+            rows = numpy.frombuffer(mv, dtype=numpy.uint8)
+            return [memoryview(row) for row in rows.reshape(count, splicenum)]
+
+        result = [mv[splicenum * z:splicenum * (z + 1)] for z in range(count)]
+        # take care of any odd bytes by extending the last view to the end
         if rem > 0:
-            result[-1] += data[-rem:]
+            result[-1] = mv[splicenum * (count - 1):]
 
         return result
 
+    def _read_all_shards(self, names: List[str]) -> bytearray:
+        """Read every named shard file from the data directory into one
+        contiguous buffer.
+
+        All file descriptors are opened up front and their sizes gathered in
+        a single pass, so the destination buffer can be allocated once --
+        never the doubled peak of a per-shard list plus a join -- and each
+        shard is read directly into a view of its final offset."""
+        dirfd = self._data_dir_fd()
+        fds = [os.open(name, os.O_RDONLY, dir_fd=dirfd) for name in names]
+        try:
+            sizes = [os.fstat(fd).st_size for fd in fds]
+            buf = bytearray(sum(sizes))
+            view = memoryview(buf)
+            offset = 0
+            for fd, size in zip(fds, sizes):
+                os.preadv(fd, [view[offset:offset + size]], 0)
+                offset += size
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return buf
+
     def load_data_from_shards(self) -> str:
         """Grab all the shards, pull all the data, and then concatenate it."""
-        result = list()
-
-        for db in self.get_shard_ids():
-            with open(f'data/{db}.txt', 'r') as f:
-                result.append(f.read())
-        return ''.join(result)
+        names = [f'{db}.txt' for db in self.get_shard_ids()]
+        return self._read_all_shards(names).decode('utf-8')
 
     def add_shard(self) -> None:
         """Add a new shard to the existing pool and rebalance the data."""
-        self.mapping = self.load_map()
-        data = self.load_data_from_shards()
-        keys = [int(z) for z in self.get_shard_ids()]
-        keys.sort()
+        names = [f'{db}.txt' for db in self.get_shard_ids()]
+        data = self._read_all_shards(names)
         # why 2? Because we have to compensate for zero indexing
-        new_shard_num = max(keys) + 2
-
-        spliced_data = self._generate_sharded_data(new_shard_num, data)
+        new_shard_num = max(self.primaries) + 2
 
-        for num, d in enumerate(spliced_data):
-            self._write_shard(num, d)
+        self._rebalance(self._generate_sharded_data(new_shard_num, data))
 
         self.write_map()
 
         self.sync_replication()
 
-    def remove_shard(self) -> None:
+    def _rebalance(self, spliced_data: List[memoryview]) -> None:
+        """Write out a freshly split set of shards, skipping the leading
+        shards whose byte range already matches the mapping -- their
+        on-disk content is identical, so rewriting them is wasted I/O.
+        Once one range differs the slice boundaries have shifted, and
+        every shard from there on must be rewritten."""
+        ranges = []
+        position = 0
+        for d in spliced_data:
+            ranges.append({
+                'start': position if position == 0 else position + 1,
+                'end': position + len(d)
+            })
+            position += len(d)
+
+        first_change = 0
+        while (first_change < len(ranges) and
+                self.primaries.get(first_change) == ranges[first_change]):
+            first_change += 1
+
+        if first_change:
+            # Seed the running position as if the skipped shards had just
+            # been written, so _write_shard_mapping continues from there.
+            self.last_char_position = ranges[first_change - 1]['end']
+
+        for num in range(first_change, len(spliced_data)):
+            self._write_shard(num, spliced_data[num])
+
+        # Replica entries are defined as mirrors of their parent's range,
+        # so refresh them now that the primaries have moved; otherwise the
+        # stale start/end values get persisted by the following write_map.
+        for db, levels in self.replicas.items():
+            parent = self.primaries[db]
+            for level in levels:
+                levels[level] = {
+                    'start': parent['start'],
+                    'end': parent['end']
+                }
+
+    def _remove_files(self, names: List[str]) -> None:
+        """Unlink a batch of files from the data directory. Callers collect
+        every victim up front so the deletions run in one tight pass instead
+        of being scattered through the bookkeeping logic."""
+        dirfd = self._data_dir_fd()
+        for name in names:
+            os.remove(name, dir_fd=dirfd)
+
+    def remove_shard(self) -> [str, None]:
         """Loads the data from all shards, removes the extra 'database' file,
         and writes the new number of shards to disk.
         """
-        pass
+        shard_ids = self.get_shard_ids()
+        if len(shard_ids) < 2:
+            return "Cannot remove shard -- at least one shard must remain."
+
+        names = [f'{db}.txt' for db in shard_ids]
+        data = self._read_all_shards(names)
+
+        victim = max(shard_ids)
+        victims = [f"{victim}.txt"]
+        for level in self.replicas.pop(victim, {}):
+            victims.append(f"{victim}-{level}.txt")
+        del self.primaries[victim]
+        self._invalidate_ids_cache()
+        self._remove_files(victims)
+
+        self._rebalance(self._generate_sharded_data(len(shard_ids) - 1, data))
+
+        self.write_map()
+
+        self.sync_replication()
 
-    def add_replication(self) -> None:
+    def add_replication(self) -> [str, None]:
         """Add a level of replication so that each shard has a backup. Label
         them with the following format:
 
@@ -163,7 +367,41 @@ class ShardHandler(object):
         to detect how many levels there are and appropriately add the next
         level.
         """
-        pass
+        if not self.primaries:
+            return "Cannot add replication -- no shards exist."
+
+        new_level = self.find_highest_replication_level() + 1
+
+        # Collect every (source, destination) pair before touching the disk
+        # so the copies run as one uninterrupted batch.
+        tasks = []
+        for db in self.primaries:
+            key = f"{db}-{new_level}"
+            tasks.append((f"{db}.txt", f"{key}.txt", key))
+
+        self._copy_batch([(src, dst) for src, dst, key in tasks])
+        for src, dst, key in tasks:
+            self._write_shard_mapping(key, b'', replication=True)
+        self.replication_level = new_level
+
+        self.write_map()
+
+    def _scan_replication_level(self) -> int:
+        """Full scan of the replicas for the highest level. Only needed when
+        the mapping is (re)loaded from disk; mutations keep
+        `replication_level` current incrementally."""
+        if not self.replicas:
+            return 0
+        return max(
+            level for levels in self.replicas.values() for level in levels
+        )
+
+    def find_highest_replication_level(self) -> int:
+        """Return the highest replication level in the mapping, or zero when
+        only primaries exist. Replication is always added and removed a
+        whole level at a time, so the tracked counter is authoritative and
+        no scan is needed."""
+        return self.replication_level
 
     def remove_replication(self) -> None:
         """Remove the highest replication level.
@@ -186,13 +424,154 @@ class ShardHandler(object):
         2.txt (shard 2, primary)
         etc...
         """
-        pass
+        if not self.replicas:
+            raise Exception("There are no replications left to remove.")
+
+        highest = self.find_highest_replication_level()
+        victims = [
+            (db, highest) for db, levels in self.replicas.items()
+            if highest in levels
+        ]
+        self._remove_files([f"{db}-{level}.txt" for db, level in victims])
+        for db, level in victims:
+            del self.replicas[db][level]
+            if not self.replicas[db]:
+                del self.replicas[db]
+        self.replication_level = highest - 1
+        self._invalidate_ids_cache()
+
+        self.write_map()
+
+    def _fast_copy(self, src: str, dst: str) -> None:
+        """Copy the named file src over dst within the data directory
+        without routing the bytes through Python. os.copy_file_range keeps
+        the copy entirely inside the kernel and can reflink on filesystems
+        that support it; os.sendfile is the next resort, and platforms with
+        neither fall back to shutil.copyfile. The destination is
+        preallocated up front so the filesystem doesn't extend it in small
+        steps."""
+        dirfd = self._data_dir_fd()
+        if not hasattr(os, 'sendfile'):
+            copyfile(f"{self.data_dir}/{src}", f"{self.data_dir}/{dst}")
+            return
+        src_fd = os.open(src, os.O_RDONLY, dir_fd=dirfd)
+        try:
+            size = os.fstat(src_fd).st_size
+            dst_fd = os.open(
+                dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644,
+                dir_fd=dirfd
+            )
+            try:
+                if size and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(dst_fd, 0, size)
+                remaining = size
+                use_cfr = hasattr(os, 'copy_file_range')
+                while remaining:
+                    offset = size - remaining
+                    if use_cfr:
+                        try:
+                            sent = os.copy_file_range(
+                                src_fd, dst_fd, remaining, offset, offset
+                            )
+                        except OSError as err:
+                            if err.errno in (errno.ENOSYS, errno.EXDEV):
+                                use_cfr = False
+                                continue
+                            raise
+                    else:
+                        sent = os.sendfile(dst_fd, src_fd, offset, remaining)
+                    remaining -= sent
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def _copy_batch(self, tasks: List[tuple]) -> None:
+        """Run a batch of independent (src, dst) copies across a thread
+        pool so the underlying disk I/O overlaps instead of queueing
+        serially behind each file. A batch of one skips the pool."""
+        if not tasks:
+            return
+        if len(tasks) == 1:
+            self._fast_copy(*tasks[0])
+            return
+        workers = min(32, (os.cpu_count() or 1) * 4, len(tasks))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(lambda t: self._fast_copy(*t), tasks))
 
     def sync_replication(self) -> None:
         """Verify that all replications are equal to their primaries and that
         any missing primaries are appropriately recreated from their
         replications."""
-        pass
+        if not os.path.exists(self.data_dir):
+            return
+
+        # One scandir pass collects every entry's name and size. The stat
+        # information comes back cached from the directory read, so neither
+        # verify below has to issue its own per-file stat calls, and both
+        # share the same partitioned view of the directory.
+        primaries = {}
+        replications = {}
+        with os.scandir(self._data_dir_fd()) as it:
+            for entry in it:
+                shard, level = _parse_name(entry.name)
+                size = entry.stat(follow_symlinks=False).st_size
+                if level is not None:
+                    replications[(shard, level)] = size
+                else:
+                    primaries[shard] = size
+
+        # Loop-invariant: the id lists don't change while verifying, so pull
+        # them out of the per-shard loops below.
+        shard_ids = self.get_shard_ids()
+        replication_ids = self.get_replication_ids()
+
+        def verify_primaries():
+            """Recreate any missing primary from one of its replications."""
+            for db in shard_ids:
+                if db in primaries:
+                    continue
+                for rep_db, level in replication_ids:
+                    if rep_db == db and (db, level) in replications:
+                        self._fast_copy(f"{db}-{level}.txt", f"{db}.txt")
+                        primaries[db] = replications[(db, level)]
+                        break
+
+        def verify_replications():
+            """Recreate any replication that is missing or does not match
+            its primary's size. The stale replicas are independent of one
+            another, so the recopies run as one parallel batch."""
+            self._copy_batch([
+                (f"{db}.txt", f"{db}-{level}.txt")
+                for db, level in replication_ids
+                if db in primaries
+                and replications.get((db, level)) != primaries[db]
+            ])
+
+        def backfill_replications():
+            """Create replicas for any primary missing a level the pool is
+            supposed to have -- e.g. a shard added after replication was
+            set up. This keeps every level complete across all shards, so
+            levels never go ragged."""
+            missing = [
+                (db, level)
+                for db in shard_ids if db in primaries
+                for level in range(1, self.replication_level + 1)
+                if level not in self.replicas.get(db, {})
+            ]
+            if not missing:
+                return
+            self._copy_batch([
+                (f"{db}.txt", f"{db}-{level}.txt") for db, level in missing
+            ])
+            for db, level in missing:
+                self._write_shard_mapping(f"{db}-{level}", b'',
+                                          replication=True)
+            self.write_map()
+
+        verify_primaries()
+        verify_replications()
+        backfill_replications()
 
     def get_shard_data(self, shardnum=None) -> [str, Dict]:
         """Return information about a shard from the mapfile."""